@@ -1,67 +1,189 @@
-from flask import Flask, request, jsonify, render_template
+from quart import Quart, Response, request, jsonify, render_template
 from youtube_transcript_api import YouTubeTranscriptApi
-from urllib.parse import urlparse, parse_qs
 import os
 from dotenv import load_dotenv
-from groq import Groq
-import concurrent.futures
-import requests
+from groq import AsyncGroq
+import asyncio
+from contextlib import aclosing
+import json
+import re
+import hashlib
+import httpx
+import numpy as np
+from diskcache import Cache
+from aiolimiter import AsyncLimiter
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize Groq client
-client = Groq(
+MODEL = "llama3-8b-8192"
+MODEL_CONTEXT_TOKENS = 8192
+SUMMARY_MAX_TOKENS = 400
+
+# Transcript chunks are budgeted by estimated input tokens
+CHARS_PER_TOKEN = 4
+CHUNK_SIZE_TOKENS = min(MODEL_CONTEXT_TOKENS - SUMMARY_MAX_TOKENS, 1500)
+
+# Initialize Groq client; the SDK retries 429s and connection errors with
+# exponential backoff, so a bounded retry count and timeout are enough here.
+# All chunk completions are multiplexed over one pooled HTTP/2 connection.
+groq_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+)
+client = AsyncGroq(
     api_key=os.environ.get("GROQ_API_KEY"),
+    timeout=30,
+    max_retries=3,
+    http_client=groq_http_client,
+)
+
+# Throttle Groq calls to the account's requests/tokens per minute budget
+GROQ_RPM = int(os.environ.get("GROQ_RPM", 30))
+GROQ_TPM = int(os.environ.get("GROQ_TPM", 30000))
+request_limiter = AsyncLimiter(GROQ_RPM, 60)
+token_limiter = AsyncLimiter(GROQ_TPM, 60)
+
+# Maximum number of summaries in flight per worker before returning 503
+CONCURRENT_PER_WORKER = int(os.environ.get("CONCURRENT_PER_WORKER", 4))
+summary_slots = asyncio.Semaphore(CONCURRENT_PER_WORKER)
+
+# Number of transcript chunks summarized per GROQ request, capped so a full
+# batch of chunks plus their summaries fits in the model context
+BATCH_PROMPT_TOKENS = 200
+BATCH_SUMMARY_TOKENS = 150
+MAX_BATCH_SIZE = max(1, (MODEL_CONTEXT_TOKENS - BATCH_PROMPT_TOKENS) // (CHUNK_SIZE_TOKENS + BATCH_SUMMARY_TOKENS))
+BATCH_SIZE = max(1, min(int(os.environ.get("SUMMARY_BATCH_SIZE", 4)), MAX_BATCH_SIZE))
+SUMMARY_DELIMITER = re.compile(r'^\s*=== SUMMARY (\d+) ===\s*$', re.MULTILINE)
+
+# Matches youtu.be/, watch?v=, embed/ and v/ URLs on YouTube hosts only, and
+# rejects IDs that run on past 11 characters. Scheme and host are case-insensitive,
+# as urlparse's hostname was; paths and the ID itself are case-sensitive.
+VIDEO_ID_PATTERN = re.compile(
+    r'^(?i:https?://)?(?i:[\w-]+\.)?'
+    r'(?:(?i:youtube\.com)/(?:watch\?(?:[^#]*&)?v=|embed/|v/)|(?i:youtu\.be)/)'
+    r'([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])'
 )
 
-app = Flask(__name__)
+# Bullet points are separated by blank lines and may already carry a marker
+BULLET_SEPARATOR = re.compile(r'\n{2,}')
+LEADING_BULLET = re.compile(r'^(?:•\s*|[*-]\s+)')
+
+# Shared HTTP client for non-Groq requests (oEmbed); its connection pool keeps
+# TLS sessions to YouTube alive between requests
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(5, connect=3),
+    transport=httpx.AsyncHTTPTransport(
+        retries=3,
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    ),
+)
+
+# Transcripts, titles and chunk summaries are cached on disk between requests
+cache = Cache(os.environ.get("CACHE_DIR", ".cache"))
+CACHE_EXPIRE = 86400
+
+app = Quart(__name__)
 
 def get_video_id(url):
     """Extract video ID from YouTube URL"""
-    query = urlparse(url)
-    if query.hostname == 'youtu.be':
-        return query.path[1:]
-    if query.hostname in ('www.youtube.com', 'youtube.com'):
-        if query.path == '/watch':
-            p = parse_qs(query.query)
-            return p['v'][0]
-        if query.path[:7] == '/embed/':
-            return query.path.split('/')[2]
-        if query.path[:3] == '/v/':
-            return query.path.split('/')[2]
-    return None
+    url = url.strip()
+    if len(url) < 11:
+        return None
+    match = VIDEO_ID_PATTERN.match(url)
+    return match.group(1) if match else None
 
 def get_transcript(video_id):
     """Get transcript of YouTube video"""
-    try:
-        transcript = YouTubeTranscriptApi.get_transcript(video_id)
+    cache_key = ('fetched_transcript', video_id)
+    transcript = cache.get(cache_key)
+    if transcript is not None:
         return transcript
+    try:
+        fetched = YouTubeTranscriptApi().fetch(video_id)
     except Exception as e:
         print(f"Error fetching transcript: {str(e)}")
         return None
 
-def chunk_transcript(transcript, chunk_size=4000):
-    """Split transcript into chunks of specified size"""
-    chunks = []
-    current_chunk = []
-    current_chunk_duration = 0
+    # Unpack the snippets once into parallel arrays that chunking can index into
+    texts, starts, durations = [], [], []
+    for snippet in fetched:
+        texts.append(snippet.text)
+        starts.append(snippet.start)
+        durations.append(snippet.duration)
+    if not texts:
+        return None
+    transcript = {
+        "texts": texts,
+        "starts": np.array(starts),
+        "durations": np.array(durations),
+    }
+    cache.set(cache_key, transcript, expire=CACHE_EXPIRE)
+    return transcript
+
+def estimate_tokens(text):
+    """Roughly estimate the token count of text (~4 characters per token)"""
+    return len(text) // CHARS_PER_TOKEN
+
+def chunk_transcript(texts, chunk_size_tokens=CHUNK_SIZE_TOKENS):
+    """Split transcript texts into (start, end) index ranges of at most chunk_size_tokens estimated tokens"""
+    if not texts:
+        return []
+
+    # Entries are joined with a space, so count it towards each entry's length
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)) + 1
+    cumulative = lengths.cumsum()
+    chunk_size_chars = chunk_size_tokens * CHARS_PER_TOKEN
+
+    # A chunk ends before the first entry that would exceed the token budget
+    boundaries = [0]
+    chunk_start_chars = 0
+    while boundaries[-1] < len(texts):
+        end = int(np.searchsorted(cumulative, chunk_start_chars + chunk_size_chars, side='right'))
+        end = max(end, boundaries[-1] + 1)
+        boundaries.append(end)
+        chunk_start_chars = cumulative[end - 1]
+
+    return list(zip(boundaries, boundaries[1:]))
 
-    for entry in transcript:
-        current_chunk.append(entry)
-        current_chunk_duration += entry['duration']
+async def reserve_tokens(tokens):
+    """Reserve tokens from the TPM budget, in several parts if they exceed it"""
+    while tokens > 0:
+        amount = min(tokens, GROQ_TPM)
+        await token_limiter.acquire(amount)
+        tokens -= amount
 
-        if current_chunk_duration >= chunk_size:
-            chunks.append(current_chunk)
-            current_chunk = []
-            current_chunk_duration = 0
+async def stream_completion(prompt, max_tokens):
+    """Stream a completion from the GROQ API within the RPM/TPM budget
 
-    if current_chunk:
-        chunks.append(current_chunk)
+    Yields (content, finish_reason) pairs; finish_reason is None until the last delta.
+    """
+    await reserve_tokens(estimate_tokens(prompt) + max_tokens)
+    async with request_limiter:
+        stream = await client.chat.completions.create(
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            model=MODEL,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+    async for chunk in stream:
+        choice = chunk.choices[0]
+        yield choice.delta.content or "", choice.finish_reason
 
-    return chunks
+def format_bullet_points(summary):
+    """Process the summary to ensure it's in bullet point format"""
+    points = [
+        f"• {LEADING_BULLET.sub('', point)}"
+        for point in (part.strip() for part in BULLET_SEPARATOR.split(summary))
+        if point
+    ]
+    return '\n'.join(points)
 
-def generate_short_summary(text, video_title, chunk_index, total_chunks):
+async def generate_short_summary(text, video_title, chunk_index, total_chunks):
     """Generate a short descriptive summary of the text using GROQ API"""
     prompt = f"""Summarize the following chunk of transcript from the video titled '{video_title}'. 
     This is chunk {chunk_index + 1} out of {total_chunks}. 
@@ -72,29 +194,82 @@ def generate_short_summary(text, video_title, chunk_index, total_chunks):
     Bullet Points (5-6):"""
 
     try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            model="llama3-8b-8192",
-        )
-        summary = chat_completion.choices[0].message.content
-        
-        # Process the summary to ensure it's in bullet point format
-        points = summary.split('\n\n')
-        formatted_points = []
-        for point in points:
-            point = point.strip()
-            if point and not point.startswith('•'):
-                point = '• ' + point
-            if point:
-                formatted_points.append(point)
-        
-        return '\n'.join(formatted_points)
+        summary = "".join([content async for content, _ in stream_completion(prompt, max_tokens=SUMMARY_MAX_TOKENS)])
+        return format_bullet_points(summary)
     except Exception as e:
         print(f"Error in summarization: {str(e)}")
         return None
 
+def summaries_in_order(delimiters, batch_size):
+    """Check that summary delimiters are numbered 1, 2, ... within the batch"""
+    return len(delimiters) <= batch_size and all(
+        int(delimiter.group(1)) == n for n, delimiter in enumerate(delimiters, start=1)
+    )
+
+async def generate_batched_summaries(chunks_batch, chunk_indices, video_title, total_chunks):
+    """Generate short summaries for several chunks of text in a single GROQ API request
+
+    chunk_indices holds each chunk's position in the video. Yields (offset, summary)
+    pairs, offset into chunks_batch, as soon as each chunk's summary has been streamed.
+    """
+    if len(chunks_batch) == 1:
+        yield 0, await generate_short_summary(chunks_batch[0], video_title, chunk_indices[0], total_chunks)
+        return
+
+    chunk_sections = "\n\n".join(
+        f"### CHUNK {n}\n{text}" for n, text in enumerate(chunks_batch, start=1)
+    )
+    prompt = f"""Summarize each of the following {len(chunks_batch)} chunks of transcript from the video titled '{video_title}'. 
+    These are chunks {', '.join(str(i + 1) for i in chunk_indices)} out of {total_chunks}. 
+    For every chunk provide exactly 5-6 bullet points that fit into the context of the entire video. 
+    Start the bullet points of chunk N with a line containing only '=== SUMMARY N ==='. Do not include any other introductory text or headers:
+
+    {chunk_sections}
+
+    Summaries ({len(chunks_batch)}):"""
+
+    completed = 0
+    try:
+        response = ""
+        finish_reason = None
+        async with aclosing(stream_completion(prompt, max_tokens=BATCH_SUMMARY_TOKENS * len(chunks_batch))) as stream:
+            async for content, reason in stream:
+                response += content
+                finish_reason = reason or finish_reason
+                # Stop reading as soon as the summaries can't be matched to their chunks
+                delimiters = list(SUMMARY_DELIMITER.finditer(response))
+                if not summaries_in_order(delimiters, len(chunks_batch)):
+                    break
+                # Every summary followed by another delimiter is complete
+                while completed < len(delimiters) - 1:
+                    summary = response[delimiters[completed].end():delimiters[completed + 1].start()]
+                    yield completed, format_bullet_points(summary)
+                    completed += 1
+
+        delimiters = list(SUMMARY_DELIMITER.finditer(response))
+        if finish_reason == "length":
+            # The summary being streamed when max_tokens was hit is cut off
+            print(f"Batched response truncated after {completed} of {len(chunks_batch)} summaries")
+        elif len(delimiters) == len(chunks_batch) and summaries_in_order(delimiters, len(chunks_batch)):
+            boundaries = [delimiter.start() for delimiter in delimiters[1:]] + [len(response)]
+            for delimiter, end in list(zip(delimiters, boundaries))[completed:]:
+                yield completed, format_bullet_points(response[delimiter.end():end])
+                completed += 1
+            return
+        else:
+            numbers = [int(delimiter.group(1)) for delimiter in delimiters]
+            print(f"Expected summaries 1-{len(chunks_batch)} in batched response, got {numbers}")
+    except Exception as e:
+        print(f"Error in batched summarization: {str(e)}")
+
+    # Fall back to summarizing the remaining chunks of this batch one at a time
+    summaries = await asyncio.gather(*[
+        generate_short_summary(text, video_title, chunk_indices[n], total_chunks)
+        for n, text in enumerate(chunks_batch[completed:], start=completed)
+    ])
+    for n, summary in enumerate(summaries, start=completed):
+        yield n, summary
+
 def format_timestamp(seconds):
     """Format seconds into a human-readable timestamp"""
     hours = int(seconds // 3600)
@@ -102,54 +277,157 @@ def format_timestamp(seconds):
     seconds = int(seconds % 60)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
-def process_chunk(chunk, i, video_title, total_chunks):
-    chunk_text = " ".join([entry['text'] for entry in chunk])
-    chunk_start_time = chunk[0]['start']
-    chunk_end_time = chunk[-1]['start'] + chunk[-1]['duration']
-    summary = generate_short_summary(chunk_text, video_title, i, total_chunks)
+def summary_cache_key(chunk_text):
+    """Key chunk summaries on the chunk text so identical chunks share a summary"""
+    return ('summary', hashlib.blake2b(chunk_text.encode()).hexdigest())
+
+def get_cached_summaries(cache_keys):
+    return [cache.get(key) for key in cache_keys]
+
+def chunk_result(transcript, chunk, chunk_index, summary):
+    start, end = chunk
+    chunk_start_time = transcript['starts'][start]
+    chunk_end_time = transcript['starts'][end - 1] + transcript['durations'][end - 1]
     return {
-        "chunk_index": i,
+        "chunk_index": chunk_index,
         "start_time": format_timestamp(chunk_start_time),
         "end_time": format_timestamp(chunk_end_time),
         "summary": summary
     }
 
-def get_video_title(video_id):
+async def process_batch(transcript, batch, first_index, video_title, total_chunks):
+    texts = transcript['texts']
+    chunk_texts = [" ".join(texts[start:end]) for start, end in batch]
+    cache_keys = [summary_cache_key(text) for text in chunk_texts]
+
+    # diskcache does blocking SQLite I/O, so keep it off the event loop
+    cached = await asyncio.to_thread(get_cached_summaries, cache_keys)
+    missing = [n for n, summary in enumerate(cached) if summary is None]
+    for n, summary in enumerate(cached):
+        if summary is not None:
+            yield chunk_result(transcript, batch[n], first_index + n, summary)
+    if not missing:
+        return
+
+    # Only the chunks without a cached summary are sent to GROQ
+    missing_texts = [chunk_texts[n] for n in missing]
+    missing_indices = [first_index + n for n in missing]
+    async for offset, summary in generate_batched_summaries(missing_texts, missing_indices, video_title, total_chunks):
+        n = missing[offset]
+        if summary is not None:
+            await asyncio.to_thread(cache.set, cache_keys[n], summary, expire=CACHE_EXPIRE)
+        yield chunk_result(transcript, batch[n], first_index + n, summary)
+
+async def summarize_chunks(transcript, chunks, video_title):
+    """Summarize all chunks concurrently, yielding each result as soon as it is ready"""
+    total_chunks = len(chunks)
+    queue = asyncio.Queue()
+
+    async def run_batch(first_index):
+        batch = chunks[first_index:first_index + BATCH_SIZE]
+        emitted = set()
+        try:
+            async for result in process_batch(transcript, batch, first_index, video_title, total_chunks):
+                emitted.add(result['chunk_index'])
+                await queue.put(result)
+        except Exception as e:
+            # Still report every chunk of the batch, without a summary
+            print(f"Error processing chunks {first_index + 1}-{first_index + len(batch)}: {str(e)}")
+            for n, chunk in enumerate(batch):
+                if first_index + n not in emitted:
+                    await queue.put(chunk_result(transcript, chunk, first_index + n, None))
+        finally:
+            await queue.put(None)
+
+    tasks = [
+        asyncio.create_task(run_batch(i))
+        for i in range(0, total_chunks, BATCH_SIZE)
+    ]
+    try:
+        pending = len(tasks)
+        while pending:
+            result = await queue.get()
+            if result is None:
+                pending -= 1
+            else:
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def get_video_title(video_id):
     """Get the title of a YouTube video using the oEmbed API"""
+    cache_key = ('title', video_id)
+    title = await asyncio.to_thread(cache.get, cache_key)
+    if title is not None:
+        return title
     url = f"https://www.youtube.com/oembed?url=http://www.youtube.com/watch?v={video_id}&format=json"
     try:
-        response = requests.get(url)
+        response = await http_client.get(url)
+        response.raise_for_status()
         data = response.json()
+        await asyncio.to_thread(cache.set, cache_key, data['title'], expire=CACHE_EXPIRE)
         return data['title']
     except Exception as e:
         print(f"Error fetching video title: {str(e)}")
         return f"Video {video_id}"
 
+@app.after_serving
+async def close_http_clients():
+    await groq_http_client.aclose()
+    await http_client.aclose()
+
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    return await render_template('index.html')
 
 @app.route('/summarize', methods=['POST'])
-def summarize():
-    youtube_url = request.json['url']
+async def summarize():
+    # Reject new work instead of queueing it once this worker is at capacity
+    if summary_slots.locked():
+        return jsonify({"error": "Server busy, please try again later"}), 503
+    await summary_slots.acquire()
+    
+    released = False
+    def release_slot(_task=None):
+        nonlocal released
+        if not released:
+            released = True
+            summary_slots.release()
+    
+    # The request task outlives the response body, so this releases the slot even
+    # if the event stream is never started; the stream releases it earlier when it ends
+    asyncio.current_task().add_done_callback(release_slot)
+    
+    data = await request.get_json()
+    youtube_url = data['url']
     video_id = get_video_id(youtube_url)
     
     if not video_id:
         return jsonify({"error": "Invalid YouTube URL"}), 400
     
-    transcript = get_transcript(video_id)
+    # Transcript and title only depend on the video ID, so fetch them together
+    transcript, video_title = await asyncio.gather(
+        asyncio.to_thread(get_transcript, video_id),
+        get_video_title(video_id),
+    )
     if not transcript:
         return jsonify({"error": "Failed to fetch transcript"}), 400
     
-    video_title = get_video_title(video_id)
-    
-    chunks = chunk_transcript(transcript)
-    total_chunks = len(chunks)
+    chunks = chunk_transcript(transcript['texts'])
     
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = list(executor.map(lambda x: process_chunk(x[1], x[0], video_title, total_chunks), enumerate(chunks)))
+    # Send each chunk summary to the client as a Server-Sent Event once it is ready
+    async def events():
+        try:
+            async for result in summarize_chunks(transcript, chunks, video_title):
+                yield f"data: {json.dumps(result)}\n\n"
+        finally:
+            release_slot()
     
-    return jsonify(results)
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.timeout = None
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,43 @@
+import os
+from dotenv import load_dotenv
+
+# Run the Quart app under uvicorn's ASGI workers:
+#   gunicorn -c gunicorn.conf.py app:app
+# Set the worker count through WEB_CONCURRENCY, not -w/--workers, since the Groq
+# budget below is split between exactly this many workers.
+
+# Load the same .env as the app, so budgets set there are the ones being split
+load_dotenv()
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * os.cpu_count() + 1))
+
+# Restart workers that stop sending heartbeats to the arbiter for this long
+timeout = 120
+
+# Each worker throttles Groq on its own, so the account's budget is split
+# between them. Every worker needs at least one request per minute, so run
+# no more workers than GROQ_RPM; the split then never adds up to more than
+# the account allows.
+groq_rpm = int(os.environ.get("GROQ_RPM", 30))
+groq_tpm = int(os.environ.get("GROQ_TPM", 30000))
+if groq_rpm < 1:
+    raise RuntimeError(f"GROQ_RPM must be at least 1, got {groq_rpm}")
+workers = min(workers, groq_rpm)
+if groq_tpm < workers:
+    raise RuntimeError(f"GROQ_TPM={groq_tpm} is too small to split between {workers} workers")
+
+raw_env = [
+    f"GROQ_RPM={groq_rpm // workers}",
+    f"GROQ_TPM={groq_tpm // workers}",
+]
+
+
+def on_starting(server):
+    # A -w/--workers override would run more workers than the budget was split for
+    if server.cfg.workers != workers:
+        raise RuntimeError(
+            f"Groq budget was split for {workers} workers but {server.cfg.workers} were requested; "
+            "set the worker count through WEB_CONCURRENCY"
+        )